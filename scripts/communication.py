@@ -1,11 +1,18 @@
-#!/usr/bin/env python
+#!/usr/bin/env python3
 """Module for managing communication lines
 Include class for Java and ROS communication
 """
 
 import abc
-from socket import socket, timeout
-from threading import Thread
+from collections import deque
+from errno import EAGAIN, EWOULDBLOCK
+from socket import socket, timeout, error as socket_error, IPPROTO_TCP, \
+    TCP_NODELAY, SOL_SOCKET, SO_REUSEADDR, SO_KEEPALIVE, SO_RCVBUF, \
+    SO_SNDBUF, MSG_DONTWAIT
+from selectors import DefaultSelector, EVENT_READ
+from struct import Struct
+from threading import Event, Thread
+import os
 import sys
 import time
 
@@ -14,36 +21,114 @@ from sonia_msgs.msg import filterchain_return_message as ret_str
 import rospy
 import time
 from observer import Observable, Observer
-import parser
+import java_parser
 
 
 # Set a buffer max size for input from socket and output to ROS line
-BUFFER_SIZE = 2048
+BUFFER_SIZE = 65536
+# Set the maximum number of reads batched before notifying observers
+MAX_BATCH_READS = 16
+# Set the size header of length prefixed Java frames, big endian uint32
+FRAME_HEADER = Struct('>I')
+# Set the kernel send and receive buffer size of the client socket
+SOCKET_BUFFER_SIZE = 1 << 20
+# Set the default number of messages kept in a line input stream
+RX_QUEUE_LEN = 16
+# Set the maximum number of requests waiting for the ROS service
+REQUEST_QUEUE_SIZE = 32
+# Set the start of rospy service errors caused by a lost connexion
+SERVICE_CONNEXION_ERRORS = ('transport error', 'unable to connect')
+
+
+class IOReactor(Thread):
+    """Single thread waiting on the sockets of every communication line
+    Lines register a socket with the callback to run when it is readable
+    """
+
+    def __init__(self):
+        """Default constructor
+        Create the selector and the pipe used to wake the thread up on stop
+        """
+        Thread.__init__(self)
+        self._selector = DefaultSelector()
+        self._wakeup_read, self._wakeup_write = os.pipe()
+        self._selector.register(self._wakeup_read, EVENT_READ)
+        self._stop_event = Event()
+        self.daemon = True
+        rospy.on_shutdown(self.stop)
 
+    def register(self, sock, callback, *args):
+        """Call callback with args each time sock is readable
+        """
+        self._selector.register(sock, EVENT_READ, (callback, args))
 
-class AbstractCommunicationLine(Observable, Observer, Thread):
-    """Abstract methods and attributes for base communication lines
-    This will provide a method send to send informations on the line
-    and will run as a thread to get information from it
+    def unregister(self, sock):
+        """Stop watching sock, must be called before closing it
+        """
+        try:
+            self._selector.unregister(sock)
+        except KeyError:
+            pass
+
+    def stop(self):
+        """Stop the reactor thread
+        """
+        self._stop_event.set()
+        os.write(self._wakeup_write, b'\0')
+
+    def run(self):
+        """Method launched when object.start() is called on the instanciated
+        object
+        """
+        while not self._stop_event.is_set() and not rospy.is_shutdown():
+            try:
+                events = self._selector.select()
+            except:
+                rospy.logwarn(sys.exc_info()[0])
+                continue
+            for key, _ in events:
+                if key.fileobj == self._wakeup_read:
+                    os.read(self._wakeup_read, 4096)
+                    continue
+                callback, args = key.data
+                try:
+                    callback(*args)
+                except:
+                    rospy.logwarn(sys.exc_info()[0])
+
+
+_reactor = None
+
+
+def get_reactor():
+    """Return the reactor shared by every communication line
+    It is started on first use
     """
+    global _reactor
+    if _reactor is None:
+        _reactor = IOReactor()
+        _reactor.start()
+    return _reactor
 
-    __metaclass__ = abc.ABCMeta  # ABC class behaves like abstract
+
+class AbstractCommunicationLine(Observable, Observer):
+    """Abstract methods and attributes for base communication lines
+    This will provide a method send to send informations on the line,
+    informations from it are received from the IOReactor or from rospy
+    """
 
     def __init__(self):
         """Default constructor, start connexions
         """
-        Thread.__init__(self)
         Observable.__init__(self)
         Observer.__init__(self)
 
-        self._input_stream = []
-        self._output_stream = []
+        self._input_stream = deque(
+            maxlen=rospy.get_param('~rx_queue_len', RX_QUEUE_LEN))
         self._connected = False
-        self._running = False
-        self.daemon = True
+        self._stop_event = Event()
 
         self._connect()
-        self.start()
 
     @abc.abstractmethod
     def _connect(self):
@@ -52,36 +137,25 @@ class AbstractCommunicationLine(Observable, Observer, Thread):
         raise NotImplementedError(
             "Class %s doesn't implement connect()" % self.__class__.__name__)
 
-    @abc.abstractmethod
-    def _process(self):
-        """Method launched when object.start() is called on the instanciated
-        object
-        """
-        raise NotImplementedError(
-            "Class %s doesn't implement run()" % self.__class__.__name__)
-
-    def run(self):
-        """Method launched when object.start() is called on the instanciated
-        object
-        """
-        self._running = True
-        while self.is_running and not rospy.is_shutdown():
-            rate = rospy.Rate(28)
-            self._process()
-            rate.sleep()
-        self._running = False
-
     def recv(self):
         """Read ouput stream and empty it
         """
-        tmp_input_stream = self._input_stream[0]
-        self._input_stream.remove(self._input_stream[0])
-        return tmp_input_stream
+        return self._input_stream.popleft()
+
+    def _push(self, data):
+        """Add data to the input stream
+        The oldest data is dropped if the consumer is falling behind
+        """
+        if len(self._input_stream) == self._input_stream.maxlen:
+            rospy.logwarn_throttle(
+                5.0, "The input stream of {!s} is full, dropping frames"
+                .format(self.get_name()))
+        self._input_stream.append(data)
 
     def stop(self):
         """Stop communication line
         """
-        self._running = False
+        self._stop_event.set()
 
     @abc.abstractmethod
     def send(self, data):
@@ -95,15 +169,13 @@ class AbstractCommunicationLine(Observable, Observer, Thread):
     def is_empty(self):
         """Check if the input stream is empty
         """
-        if len(self._input_stream):
-            return False
-        return True
+        return not self._input_stream
 
     @property
     def is_running(self):
-        """Check if the input stream is empty
+        """Check if the line was not stopped
         """
-        return self._running
+        return not self._stop_event.is_set()
 
     @property
     def is_connected(self):
@@ -125,18 +197,27 @@ class AbstractCommunicationLine(Observable, Observer, Thread):
 class JavaCommunicationLine(AbstractCommunicationLine):
     """An easy to use API for making a dialog on TCP/IP Line
     This class is server class and provides reading and writing socket
+    Messages are delimited by a newline, or prefixed by their size in
+    FRAME_HEADER if length_prefixed is set
     """
 
-    def __init__(self, host='', port=46626):
+    def __init__(self, host='', port=46626, length_prefixed=False):
         """Default constructor
         Initiate variables, Connect the socket and call parent constructor
         """
         self.host = host
         self.port = port
+        self._length_prefixed = length_prefixed
         self._backlog = 5
         self._socket = None
         self._clients = []
         self._started = False
+        self._buf = bytearray(BUFFER_SIZE)
+        self._view = memoryview(self._buf)
+        self._len = 0
+        # Set when a line overflowed the buffer, until its end is received
+        self._discarding = False
+        self._reactor = get_reactor()
 
         AbstractCommunicationLine.__init__(self)
 
@@ -145,6 +226,8 @@ class JavaCommunicationLine(AbstractCommunicationLine):
         """
         try:
             self._socket = socket()
+            self._socket.setsockopt(SOL_SOCKET, SO_REUSEADDR, 1)
+            self._socket.setsockopt(SOL_SOCKET, SO_KEEPALIVE, 1)
             self._socket.bind((self.host, self.port))
             self._socket.listen(self._backlog)
             self._socket.settimeout(2)
@@ -158,90 +241,164 @@ class JavaCommunicationLine(AbstractCommunicationLine):
             'Socket server running at : ' +
             str(self.host) + ":" + str(self.port))
         # Always accept connexions
-        self._connexion_thread = Thread(target=self._accept_client)
-        self._connexion_thread.daemon = True
-        self._connexion_thread.start()
+        self._reactor.register(self._socket, self._accept_client)
 
     def _accept_client(self):
-        while True:
-            client, client_ip = self._socket.accept()
-            self._clients = []
-            self._clients.append((client, client_ip))
-            rospy.loginfo(
-                'A client is connected : ' + str(self._clients[-1][1][0]) +
-                ':' + str(self._clients[-1][1][1]))
+        """Method called by the reactor when a client is connecting
+        """
+        client, client_ip = self._socket.accept()
+        # Send small commands right away instead of waiting for Nagle
+        client.setsockopt(IPPROTO_TCP, TCP_NODELAY, 1)
+        client.setsockopt(SOL_SOCKET, SO_RCVBUF, SOCKET_BUFFER_SIZE)
+        client.setsockopt(SOL_SOCKET, SO_SNDBUF, SOCKET_BUFFER_SIZE)
+        for old_client in list(self._clients):
+            self._drop_client(old_client)
+        self._clients = [(client, client_ip)]
+        self._reactor.register(
+            client, self._read_from_line, (client, client_ip))
+        rospy.loginfo(
+            'A client is connected : ' + str(client_ip[0]) +
+            ':' + str(client_ip[1]))
 
     def stop(self):
         """Close connexion properly
         Override parent class to add socket closing process
         """
+        for client in self._clients:
+            self._reactor.unregister(client[0])
+        self._reactor.unregister(self._socket)
         self._socket.close()
         self._started = False
         super(JavaCommunicationLine, self).stop()
 
-    def _process(self):
-        """Method used by thread processing until stop() is used
-        Will read on the line and notify observer if there is any informations
+    def _read_from_line(self, client):
+        """Method called by the reactor when the client socket is readable
+        Data is received in a preallocated buffer until the socket has no
+        more pending data, then the list of every complete message is
+        pushed on the input stream at once and observers are notified a
+        single time
         """
-        rospy.logwarn("BEFORE READLINE")
-        self._read_from_line()
-        rospy.logwarn("AFTER READLINE")
-        if not self.is_empty:
+        lines = []
+        flags = 0
+        for _ in range(MAX_BATCH_READS):
+            if self._len == len(self._buf):
+                rospy.logerr(
+                    "The line from AUV6 exceeds {!s} bytes, dropping it"
+                    .format(len(self._buf)))
+                self._len = 0
+                self._discarding = True
+            free = len(self._buf) - self._len
+            try:
+                n = client[0].recv_into(self._view[self._len:], free, flags)
+            except socket_error as e:
+                if e.errno not in (EAGAIN, EWOULDBLOCK):
+                    raise
+                break
+            if not n:
+                rospy.logwarn(
+                    "The client {!s}:{!s} closed the connexion".format(
+                        client[1][0], client[1][1]))
+                self._drop_client(client)
+                break
+            self._len += n
+            if not self._split_lines(client, lines) or n < free:
+                break
+            # Only take what is already there on the following reads
+            flags = MSG_DONTWAIT
+        if lines:
+            self._push(lines)
             self._notify()
-        rospy.logwarn("BEFORE OUTPUT_STREAM")
-        if len(self._output_stream):
-            self._write_to_line()
-
 
-    def _read_from_line(self):
-        """Read informations from tcp socket
+    def _drop_client(self, client):
+        """Stop reading from client, close its socket and forget the data
+        received from it
         """
-        rospy.logwarn("number of clients  : {!s}"
-                    .format(self._clients.__len__()))
-        for client in self._clients:
-            try:
-                rospy.logwarn("123")
-                line = client[0].recv(2048)
-                """line = client[0].makefile().readline().rstrip('\n')"""
-                rospy.logwarn("1234")
-                if line:
-                    rospy.logwarn("1235")
-                    rospy.loginfo("I received data from AUV6 : \"" + line + "\"")
-                    if line == "END\n":
-                        rospy.logwarn(
-                            "The client {!s}:{!s} ended the connexion".format(
-                                client[1][0], client[1][1]))
-                        return
-                    self._input_stream.append(line)
-            except:
-                rospy.logwarn(sys.exc_info()[0])
-
-    def _write_to_line(self):
-        for client in self._clients:
-            #rospy.loginfo(
-            #    "I am Sending data to AUV6 on {!s}:{!s} : \"".format(
-            #        client[1][0], client[1][1]) +
-            #    self._output_stream[0] + "\"")
-            try:
-                client[0].send(self._output_stream[0] + "\n")
-            except:
+        self._reactor.unregister(client[0])
+        client[0].close()
+        if client in self._clients:
+            self._clients.remove(client)
+        self._len = 0
+        self._discarding = False
+
+    def _next_frame(self, start):
+        """Find the message of the frame beginning at start in the buffer
+        Return the message bounds and the start of the next frame, or None
+        if the frame is not complete yet
+        """
+        if self._length_prefixed:
+            if self._len - start < FRAME_HEADER.size:
+                return None
+            size, = FRAME_HEADER.unpack_from(self._buf, start)
+            begin = start + FRAME_HEADER.size
+            end = begin + size
+            if end > self._len:
+                return None
+            return begin, end, end
+        end = self._buf.find(b'\n', start, self._len)
+        if end == -1:
+            return None
+        return start, end, end + 1
+
+    def _split_lines(self, client, lines):
+        """Move the complete messages of the buffer to lines
+        The remaining bytes are kept at the start of the buffer.
+        Return False if the client ended the connexion
+        """
+        start = 0
+        if self._discarding:
+            # Drop the rest of the line that overflowed the buffer
+            end = self._buf.find(b'\n', 0, self._len)
+            if end == -1:
+                self._len = 0
+                return True
+            start = end + 1
+            self._discarding = False
+        frame = self._next_frame(start)
+        while frame is not None:
+            begin, end, start = frame
+            line = self._view[begin:end].tobytes().decode('ascii', 'replace')
+            rospy.logdebug("I received data from AUV6 : \"%s\"", line)
+            if line == "END":
+                rospy.logwarn(
+                    "The client {!s}:{!s} ended the connexion".format(
+                        client[1][0], client[1][1]))
+                self._len = 0
+                return False
+            lines.append(line)
+            frame = self._next_frame(start)
+        if self._length_prefixed and self._len - start >= FRAME_HEADER.size:
+            size, = FRAME_HEADER.unpack_from(self._buf, start)
+            if size > len(self._buf) - FRAME_HEADER.size:
+                # The frame can never fit, the next frame boundary is lost
                 rospy.logerr(
-                    "The client {!s}:{!s} disconnected without "
-                    .format(client[1][0], client[1][1]) +
-                    "closing the connexion")
-
-        self._output_stream = self._output_stream[1:]
+                    "The frame from AUV6 has {!s} bytes, more than the "
+                    "{!s} bytes buffer, closing the connexion".format(
+                        size, len(self._buf) - FRAME_HEADER.size))
+                self._drop_client(client)
+                return False
+        if start:
+            keep = self._len - start
+            self._buf[:keep] = self._buf[start:self._len]
+            self._len = keep
+        return True
 
     def send(self, data):
         """Send informations to tcp socket
+        The message is encoded once and written with a single sendall call
         """
+        if not isinstance(data, (bytes, bytearray)):
+            data = data.encode('ascii', 'replace')
+        if self._length_prefixed:
+            frame = FRAME_HEADER.pack(len(data)) + data
+        else:
+            frame = data + b'\n'
         for client in self._clients:
             #rospy.loginfo(
             #    "I am Sending data to AUV6 on {!s}:{!s} : \"".format(
             #        client[1][0], client[1][1]) +
             #    data + "\"")
             try:
-                client[0].send(data + "\n")
+                client[0].sendall(frame)
             except timeout:
                 rospy.logwarn("socket timeout ! Resetting connection ...")
                 self.stop()
@@ -267,14 +424,21 @@ class JavaCommunicationLine(AbstractCommunicationLine):
 class ROSTopicCommunicationLine(AbstractCommunicationLine):
     """Initiate a communication with ROS Topic given a writing
     and reading topic node_name
+    Messages are received and published from rospy threads
     """
 
-    def __init__(self, reading_topic, writing_topic=None):
+    def __init__(self, reading_topic, writing_topic=None, queue_size=1,
+                 buff_size=2 ** 24, tcp_nodelay=True):
         """Default Constructor
         init node and topics
+        buff_size should be at least queue_size times the average message
+        size so rospy does not coalesce messages in the socket buffer
         """
         self._writing_topic = writing_topic
         self._reading_topic = reading_topic
+        self._queue_size = queue_size
+        self._buff_size = buff_size
+        self._tcp_nodelay = tcp_nodelay
 
         AbstractCommunicationLine.__init__(self)
 
@@ -283,48 +447,44 @@ class ROSTopicCommunicationLine(AbstractCommunicationLine):
         """
         rospy.loginfo(
             "I am subscribing to ROS reading topic : " + self._reading_topic)
-        rospy.Subscriber(
-            self._reading_topic, ret_str, self._handle_read_subscribers)
+        self._subscriber = rospy.Subscriber(
+            self._reading_topic, ret_str, self._handle_read_subscribers,
+            queue_size=self._queue_size, buff_size=self._buff_size,
+            tcp_nodelay=self._tcp_nodelay)
         if self._writing_topic:
             rospy.loginfo(
                 "I am subscribing to ROS writing topic : " +
-                self.writing_topic)
+                self._writing_topic)
             self.publisher = rospy.Publisher(
                 self._writing_topic, String, queue_size=20)
 
-    def _process(self):
-        """Method used by thread
-        simply keeps python from exiting until this node is stopped
-        """
-        if len(self._output_stream):
-            if self._writing_topic:
-                rospy.loginfo(
-                    "I am sending data to ROS Topic : \"" +
-                    self._output_stream[0] + "\"")
-                self.publisher.publish(self._output_stream[0])
-                self._output_stream = self._output_stream[1:]
-            else:
-                rospy.logerr(
-                    "Sorry, you did not provide me any topic to publish on...")
-
-
     def _handle_read_subscribers(self, data):
         """Method called when receiving informations from Subscribers
         """
-        self._input_stream.append(data.execution_result)
-        rospy.loginfo(
-            "I received data from ROS Topic : \"" +
-            self._input_stream[-1] +
-            "\" - ["+ data.execution_result +"] "
-        )
+        self._push(data.execution_result)
+        rospy.logdebug(
+            "I received data from ROS Topic : \"%s\"", data.execution_result)
         self._notify()
 
+    def stop(self):
+        """Stop listening the reading topic
+        Override parent class to unregister the subscriber
+        """
+        self._subscriber.unregister()
+        super(ROSTopicCommunicationLine, self).stop()
+
     def stopTopic(self):
         self.stop()
+
     def send(self, data):
         """Send informations to publisher
         """
-        self._output_stream.append(data)
+        if self._writing_topic:
+            rospy.logdebug("I am sending data to ROS Topic : \"%s\"", data)
+            self.publisher.publish(data)
+        else:
+            rospy.logerr(
+                "Sorry, you did not provide me any topic to publish on...")
 
     def get_name(self):
         return self._reading_topic
@@ -339,6 +499,10 @@ class ROSServiceCommunicationLine(AbstractCommunicationLine):
         """
         self._service_name = service_name
         self._service_ref = service_ref
+        # Single producer, single consumer : deque appends and pops are
+        # atomic so only the wake up of the worker needs the Event
+        self._requests = deque(maxlen=REQUEST_QUEUE_SIZE)
+        self._pending = Event()
 
         AbstractCommunicationLine.__init__(self)
 
@@ -346,48 +510,92 @@ class ROSServiceCommunicationLine(AbstractCommunicationLine):
         """
         """
         rospy.loginfo("I am connecting to Vision Server ROS service")
+        rospy.wait_for_service(self._service_name)
         self._service_response = rospy.ServiceProxy(
-            self._service_name, self._service_ref)
+            self._service_name, self._service_ref, persistent=True)
+        self._worker = Thread(target=self._process_requests)
+        self._worker.daemon = True
+        self._worker.start()
+        rospy.on_shutdown(self.stop)
 
-    def _process(self):
-        """Method used by thread
-        simply keeps python from exiting until this node is stopped
+    def stop(self):
+        """Stop the worker thread
+        Override parent class to wake the worker up
         """
-        if len(self._output_stream):
-            rospy.wait_for_service(self._service_name)
-            try:
-                rospy.loginfo(
-                    "I am sending data to Vision Server : \"" +
-                    "node_name : " + self._output_stream[0][0] +
-                    " filterchain_name : " + self._output_stream[0][1] +
-                    " media_name : " + self._output_stream[0][2] +
-                    " cmd : " + str(self._output_stream[0][3]) + "\"")
-                self._input_stream.append(str(self._service_response(
-                    self._output_stream[0][0], self._output_stream[0][1],
-                    self._output_stream[0][2], self._output_stream[0][3])))
-                self._output_stream = self._output_stream[1:]
-                if not self.is_empty:
-                    rospy.loginfo(
-                        "I received data from Vision Server : \"" +
-                        self._input_stream[-1] + "\"")
-                    self._notify()
-            except rospy.ServiceException, e:
-                rospy.logerr("Service call failed: %s" % e)
+        super(ROSServiceCommunicationLine, self).stop()
+        self._pending.set()
+
+    def _call_service(self, request):
+        """Call the service on the persistent connexion
+        Reconnect and retry once if the connexion was lost, for instance
+        when the Vision Server restarted. Errors raised by the service
+        handler are not retried since the commands are not idempotent
+        """
+        try:
+            return self._service_response(*request)
+        except rospy.exceptions.TransportException as e:
+            # Raised when sending on the transport of a dead connexion
+            error = e
+        except rospy.ServiceException as e:
+            # Handler errors "responded with an error" are not retried
+            if not str(e).startswith(SERVICE_CONNEXION_ERRORS):
+                raise
+            error = e
+        rospy.logwarn("Lost connexion to {!s} ({!s}), reconnecting"
+                      .format(self._service_name, error))
+        self._service_response.close()
+        self._service_response = rospy.ServiceProxy(
+            self._service_name, self._service_ref, persistent=True)
+        return self._service_response(*request)
+
+    def _process_requests(self):
+        """Method used by the worker thread until stop() is used
+        """
+        while not self._stop_event.is_set() and not rospy.is_shutdown():
+            self._pending.wait()
+            self._pending.clear()
+            while self._requests and not self._stop_event.is_set():
+                try:
+                    self._process(self._requests.popleft())
+                except:
+                    # A bad request must not stop the worker
+                    rospy.logerr(
+                        "Request to {!s} failed : {!r}".format(
+                            self._service_name, sys.exc_info()[1]))
+
+    def _process(self, request):
+        """Call the service with request, so the blocking call never runs
+        on the thread reading the Java line
+        """
+        try:
+            rospy.logdebug(
+                "I am sending data to Vision Server : \"node_name : %s "
+                "filterchain_name : %s media_name : %s cmd : %s\"",
+                *request)
+            self._push(self._call_service(request).response)
+            rospy.logdebug(
+                "I received data from Vision Server : \"%s\"",
+                self._input_stream[-1])
+            self._notify()
+        except rospy.ServiceException as e:
+            rospy.logerr("Service call failed: %s" % e)
 
     def send(self, node_name, filterchain_name, media_name, cmd):
-        """Loop and get information from service
+        """Queue a request for the service
         """
-        self._output_stream.append((
-            node_name, filterchain_name, media_name, cmd))
+        if len(self._requests) == self._requests.maxlen:
+            rospy.logwarn_throttle(
+                5.0, "Too many requests waiting for {!s}, dropping the oldest"
+                .format(self._service_name))
+        self._requests.append((node_name, filterchain_name, media_name, cmd))
+        self._pending.set()
 
     def update(self, subject):
         """
         """
-        splitted = subject.recv().split("\n")
-        for line in splitted:
-            parsed_str = parser.parse_from_java(line)
+        for line in subject.recv():
+            parsed_str = java_parser.parse_from_java(line)
             if parsed_str is not None:
-                print("sending informations")
                 self.send(parsed_str[0], parsed_str[1], parsed_str[2], parsed_str[3])
 
 
@@ -1,4 +1,4 @@
-#!/usr/bin/env python
+#!/usr/bin/env python3
 
 import rospy
 
@@ -9,7 +9,6 @@ def parse_from_java(string_to_parse):
             "I received an empty string from Java")
         return None
     parsed_tab = string_to_parse.split(';')
-    print(string_to_parse)
     if len(parsed_tab) != 4:
         if len(parsed_tab) == 0:
             rospy.logerr(
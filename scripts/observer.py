@@ -6,13 +6,11 @@ import abc
 import rospy
 
 
-class Observable(object):
+class Observable(metaclass=abc.ABCMeta):
     """Simple Observer class
     Allow childs class to notify subscribers with notify
     """
 
-    __metaclass__ = abc.ABCMeta  # ABC class behaves like abstract
-
     def __init__(self):
         """Default Constructor
         Initiat class attributes
@@ -49,12 +47,10 @@ class Observable(object):
                     observer.update(self)
 
 
-class Observer(object):
+class Observer(metaclass=abc.ABCMeta):
     """
     """
 
-    __metaclass__ = abc.ABCMeta  # ABC class behaves like abstract
-
     @abc.abstractmethod
     def get_name(self):
         pass
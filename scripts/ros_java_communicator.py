@@ -1,8 +1,11 @@
-#!/usr/bin/env python
+#!/usr/bin/env python3
+
+from threading import Lock
 
 import communication
 from observer import Observer
 import rospy
+from std_msgs.msg import String
 from sonia_msgs.srv import vision_server_execute_cmd as service_ref
 
 # Set the IP adress of the java socket server, localhost if on the same machine
@@ -19,37 +22,42 @@ class ROSJavaCommunicator(Observer):
 
     def __init__(self):
         rospy.init_node(NODE_NAME, anonymous=False)
-        self._topics = []
+        self._topics = {}
+        # send() runs on the service worker, drop_topic() on a rospy thread
+        self._topics_lock = Lock()
 
         self.ros_service_line = communication.ROSServiceCommunicationLine(
             SERVICE_NAME, service_ref)
         self.java_line = communication.JavaCommunicationLine(
-            TCP_IP, TCP_PORT)
+            TCP_IP, TCP_PORT,
+            rospy.get_param('~length_prefixed', False))
 
         self.java_line.attach(self.ros_service_line)
         self.ros_service_line.attach(self)
 
+        # Publish a topic name on it to stop listening that topic
+        rospy.Subscriber('~drop_topic', String, self._handle_drop_topic)
 
         rospy.spin()
 
-    def _update(self, service):
-        topic_name = service.recv()
-        if topic_name.is_empty:
-            return
-        topic_name += "_result"
-
-        print("Now listening " + topic_name)
+    def _handle_drop_topic(self, data):
+        """Method called when receiving a topic name to stop listening
+        """
+        self.drop_topic(data.data)
 
-        for topic in self._topics:
-            if topic.get_name() == topic_name:
+    def drop_topic(self, topic_name):
+        """Stop listening topic_name and release its subscriber
+        """
+        with self._topics_lock:
+            topic = self._topics.pop(topic_name, None)
+            if topic is None:
                 rospy.logwarn(
-                    "Sorry, but {!s} is already listening on topic {!s}"
-                    .format(self.java_line.get_name(), topic.get_name()))
+                    "Sorry, but {!s} is not listening on topic {!s}"
+                    .format(self.java_line.get_name(), topic_name))
                 return
-
-        topic = communication.ROSTopicCommunicationLine(topic_name)
-        topic.attach(self.java_line)
-        self._topics.append(topic)
+            topic.detach(self.java_line)
+            topic.stopTopic()
+        rospy.loginfo("Stopped listening " + topic_name)
 
     def get_name(self):
         return "Control Loop"
@@ -58,25 +66,24 @@ class ROSJavaCommunicator(Observer):
         """Send a message on the line
         Abstract method to rewrite
         """
-        rospy.loginfo("I am supposed to send these datas to ROS service : \"" + data + "\"")
-        topic_name = data.replace("response: ","")
-        if topic_name == "''":
+        rospy.logdebug(
+            "I am supposed to send these datas to ROS service : \"%s\"", data)
+        if not data:
             return
-        topic_name += "_result"
+        topic_name = data + "_result"
+
+        with self._topics_lock:
+            if topic_name in self._topics:
+                rospy.logdebug(
+                    "%s is already listening on topic %s",
+                    self.java_line.get_name(), topic_name)
+                return
 
-        print("Now listening " + topic_name)
+            rospy.loginfo("Now listening %s", topic_name)
 
-        for topic in self._topics:
-            if topic.get_name() == topic_name:
-                rospy.logwarn(
-                    "Sorry, but {!s} is already listening on topic {!s}, resetting topics"
-                    .format(self.java_line.get_name(), topic.get_name()))
-                topic.stopTopic()
-                self._topics.remove(topic)
-
-        topic = communication.ROSTopicCommunicationLine(topic_name)
-        topic.attach(self.java_line)
-        self._topics.append(topic)
+            topic = communication.ROSTopicCommunicationLine(topic_name)
+            topic.attach(self.java_line)
+            self._topics[topic_name] = topic
 
 
 if __name__ == '__main__':